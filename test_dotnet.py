@@ -2,70 +2,193 @@
 import sys
 import os
 import subprocess
-import glob
 import re
-import tempfile
+import shlex
+import shutil
+import signal
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import combinations
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
-from typing import List, Optional, Set, Dict
+from typing import List, Optional, Set, Dict, Tuple
+
+_PKG_RE = re.compile(r"dotnet-(?:(\d+)-)?(sdk-)?(\d+)\.\d+")
+_FW_RE = re.compile(r"net(\d+)\.\d+")
+
+# Web API projects run concurrently, so each one listens on its own port
+WEBAPI_PORTS = {"webapi": 5000, "webapiaot": 5001}
+
+# One session per port, since the webapi probes run concurrently
+_SESSIONS: Dict[int, requests.Session] = {}
+
+
+def _session(port: int) -> requests.Session:
+    """Get the HTTP session for a webapi port, creating it on first use"""
+    session = _SESSIONS.get(port)
+    if session is None:
+        session = _SESSIONS[port] = requests.Session()
+        session.mount(
+            "http://", HTTPAdapter(pool_connections=1, pool_maxsize=1, max_retries=0)
+        )
+    return session
+
+
+def _spawn_wait(argv: List[str]) -> int:
+    """Spawn a command inheriting stdio and wait for its exit code"""
+    # Undo the signals Python ignores, as subprocess does with restore_signals
+    pid = os.posix_spawnp(
+        argv[0], argv, os.environ, setsigdef=(signal.SIGPIPE, signal.SIGXFSZ)
+    )
+    try:
+        _, status = os.waitpid(pid, 0)
+    except BaseException:
+        # Give a child that also got the Ctrl-C a moment to exit cleanly
+        deadline = time.monotonic() + 0.25
+        while os.waitpid(pid, os.WNOHANG) == (0, 0):
+            if time.monotonic() >= deadline:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                break
+            time.sleep(0.01)
+        raise
+    return os.waitstatus_to_exitcode(status)
 
 
 class DotNetTester:
     def __init__(self, base_dir: str = "/var/lib/solbuild/local"):
         self.base_dir = base_dir
         self.versions = {}
+        # Versions known to be installed; None until the first full uninstall
+        self._installed: Optional[frozenset] = None
+        self._programs: Dict[str, str] = {}
         self._enumerate_packages()
 
-    def run_command(self, cmd, check=True, capture_output=False, shell=False):
+        self._framework = {v: f"net{v}.0" for v in self._available_versions}
+        self._build_cmd = {
+            v: ["dotnet", "build", ".", f"-p:framework={framework}"]
+            for v, framework in self._framework.items()
+        }
+        self._publish_cmd = {
+            v: [
+                "dotnet",
+                "publish",
+                "console",
+                "-c",
+                "Release",
+                "-r",
+                "solus.4-x64",
+                "--self-contained",
+                "true",
+                "-p:PublishSingleFile=true",
+                f"-p:framework={framework}",
+            ]
+            for v, framework in self._framework.items()
+        }
+
+    def run_command(
+        self,
+        cmd: List[str],
+        *,
+        check: bool = True,
+        capture_output: bool = False,
+        quiet: bool = False,
+    ):
         """Run a command and handle errors"""
-        if isinstance(cmd, str) and not shell:
-            cmd = cmd.split()
+        # Only argv[0]; sudo resolves its target itself via secure_path
+        cmd = [self._resolve(cmd[0]), *cmd[1:]]
 
         try:
             if capture_output:
                 result = subprocess.run(
-                    cmd, capture_output=True, text=True, check=check, shell=shell
+                    cmd, capture_output=True, text=True, check=check
                 )
+                if result.returncode != 0:
+                    return None
                 return result.stdout.strip()
+            elif quiet:
+                # Keep stderr so a failure still shows why
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, check=check)
             else:
-                subprocess.run(cmd, check=check, shell=shell)
+                returncode = _spawn_wait(cmd)
+                if check and returncode != 0:
+                    raise subprocess.CalledProcessError(returncode, cmd)
         except subprocess.CalledProcessError as e:
             if check:
-                print(
-                    f"Command failed: {' '.join(cmd) if isinstance(cmd, list) else cmd}"
-                )
+                print(f"Command failed: {shlex.join(cmd)}")
                 sys.exit(1)
             return None
 
+    def _resolve(self, program: str) -> str:
+        """Resolve a program on $PATH once, caching the absolute path"""
+        path = self._programs.get(program)
+        if path is None:
+            if os.sep in program:
+                return program
+            # dotnet only appears once installed, so misses are not cached
+            path = shutil.which(program)
+            if path is None:
+                return program
+            self._programs[program] = path
+        return path
+
     def _enumerate_packages(self):
         """Analyze available packages and group by major version"""
-        packages = glob.glob(f"{self.base_dir}/dotnet-*.eopkg")
-
-        for pkg in packages:
-            basename = os.path.basename(pkg)
+        try:
+            with os.scandir(self.base_dir) as entries:
+                packages = [
+                    (e.path, e.name)
+                    for e in entries
+                    if e.name.startswith("dotnet-")
+                    and e.name.endswith(".eopkg")
+                    and e.is_file()
+                ]
+        except FileNotFoundError:
+            packages = []
 
+        self._basenames = {}
+        for pkg, basename in packages:
             if "source-built-artifacts" in basename:
                 continue
 
             if basename.startswith("dotnet-shared-"):
                 self.versions.setdefault("shared", []).append(pkg)
+                self._basenames[pkg] = basename
                 continue
 
-            match = re.match(r"dotnet-(?:(\d+)-)?(sdk-)?(\d+)\.\d+", basename)
+            match = _PKG_RE.match(basename)
             if match:
                 major_version = match.group(1) or match.group(3).split(".")[0]
                 self.versions.setdefault(major_version, []).append(pkg)
-
-    def get_available_versions(self) -> List[str]:
+                self._basenames[pkg] = basename
+
+        self._available_versions = tuple(
+            sorted(v for v in self.versions if v != "shared")
+        )
+        # eopkg files are named <name>-<version>-<release>-<build>-<arch>.eopkg
+        self._package_names = {
+            pkg: basename.rsplit("-", 4)[0] for pkg, basename in self._basenames.items()
+        }
+        self._package_counts = {}
+        for version, pkg_list in self.versions.items():
+            sdk_count = sum(1 for p in pkg_list if "sdk" in self._basenames[p].lower())
+            self._package_counts[version] = (len(pkg_list) - sdk_count, sdk_count)
+
+    def get_available_versions(self) -> Tuple[str, ...]:
         """Get all available major versions (excluding 'shared')"""
-        return [v for v in self.versions.keys() if v != "shared"]
+        return self._available_versions
+
+    def get_package_counts(self, version: str) -> Tuple[int, int]:
+        """Get the (runtime, sdk) package counts for a version"""
+        return self._package_counts[version]
 
-    def install_dotnet(self, versions: List[str]):
+    def install_dotnet(self, versions: List[str], include_shared: bool = True):
         """Install dotnet packages for the specified versions"""
         packages_to_install = []
 
-        if "shared" in self.versions:
+        if include_shared and "shared" in self.versions:
             print("Including dotnet-shared packages...")
             packages_to_install.extend(self.versions["shared"])
 
@@ -83,40 +206,86 @@ class DotNetTester:
 
         print(f"\nInstalling {len(packages_to_install)} packages:")
         for pkg in packages_to_install:
-            print(f"  - {os.path.basename(pkg)}")
+            print(f"  - {self._basenames[pkg]}")
 
         cmd = ["sudo", "eopkg", "it"] + packages_to_install
         self.run_command(cmd)
 
+        if self._installed is not None:
+            self._installed |= frozenset(versions)
+
+    def _installed_dotnet(self) -> Optional[frozenset]:
+        """Get the names of installed dotnet packages, or None if unknown"""
+        try:
+            output = self.run_command(
+                ["eopkg", "li", "-N"], check=False, capture_output=True
+            )
+        except OSError:
+            return None
+        if output is None:
+            return None
+
+        names = (fields[0] for fields in map(str.split, output.splitlines()) if fields)
+        return frozenset(name for name in names if name.startswith("dotnet"))
+
     def uninstall_all_dotnet(self):
         """Uninstall all dotnet packages"""
         print("Uninstalling all dotnet packages...")
 
-        packages_to_remove = ["dotnet-shared"]
+        packages_to_remove = ["dotnet-shared", "dotnet", "dotnet-sdk"]
 
         for version in self.get_available_versions():
-            packages_to_remove.extend(
-                [
-                    f"dotnet-{version}",
-                    f"dotnet-{version}-sdk",
-                    "dotnet",
-                    "dotnet-sdk",
-                ]
-            )
-
-        seen = set()
-        unique_packages = []
-        for pkg in packages_to_remove:
-            if pkg not in seen:
-                seen.add(pkg)
-                unique_packages.append(pkg)
+            packages_to_remove.extend([f"dotnet-{version}", f"dotnet-{version}-sdk"])
+
+        # Available versions are unique, so these names never repeat
+        installed = self._installed_dotnet()
+        if installed is not None:
+            packages_to_remove = [p for p in packages_to_remove if p in installed]
+            if not packages_to_remove:
+                print("No dotnet packages installed")
+                self._installed = frozenset()
+                return
+
+        cmd = ["sudo", "eopkg", "remove"] + packages_to_remove
+        self.run_command(cmd)
+        self._installed = frozenset()
+
+    def remove_dotnet(self, versions: List[str]):
+        """Remove the dotnet packages for the specified versions"""
+        packages_to_remove = [
+            self._package_names[pkg]
+            for version in versions
+            for pkg in self.versions.get(version, [])
+        ]
+        print(f"Removing .NET {', '.join(versions)}...")
 
-        cmd = ["sudo", "eopkg", "remove"] + unique_packages
+        packages_to_remove = list(dict.fromkeys(packages_to_remove))
+        cmd = ["sudo", "eopkg", "remove"] + packages_to_remove
         self.run_command(cmd)
+        self._installed -= frozenset(versions)
+
+    def switch_to(self, versions: List[str]):
+        """Bring the installed dotnet packages to exactly the given versions"""
+        current = self._installed
+        if current is None:
+            self.uninstall_all_dotnet()
+            self.install_dotnet(versions)
+            return
+
+        to_remove = [v for v in sorted(current) if v not in versions]
+        to_add = [v for v in versions if v not in current]
+        if not to_remove and not to_add:
+            print(f"Already installed: .NET {', '.join(versions)}")
+            return
+
+        if to_remove:
+            self.remove_dotnet(to_remove)
+        if to_add:
+            self.install_dotnet(to_add, include_shared=not current)
 
     def get_framework_version(self, major_version: str) -> str:
         """Get the framework version string for a major version"""
-        return f"net{major_version}.0"
+        return self._framework.get(major_version) or f"net{major_version}.0"
 
     def run_tests(self, major_version: str):
         """Run dotnet tests for the specified major version"""
@@ -125,28 +294,15 @@ class DotNetTester:
 
         # Build solution
         print("Building solution...")
-        self.run_command(f"dotnet build . -p:framework={framework}")
+        self.run_command(list(self._build_cmd[major_version]))
 
         # Publish self-contained
         print("Publishing self contained...")
-        publish_cmd = [
-            "dotnet",
-            "publish",
-            "console",
-            "-c",
-            "Release",
-            "-r",
-            "solus.4-x64",
-            "--self-contained",
-            "true",
-            "-p:PublishSingleFile=true",
-            f"-p:framework={framework}",
-        ]
-        self.run_command(publish_cmd)
+        self.run_command(list(self._publish_cmd[major_version]))
 
         # Test console app
         console_path = f"./console/bin/Debug/{framework}/console"
-        result = self.run_command(console_path, capture_output=True)
+        result = self.run_command([console_path], capture_output=True)
 
         if result != "SUCCESS":
             print(f"Console app test failed: expected 'SUCCESS', got '{result}'")
@@ -155,43 +311,55 @@ class DotNetTester:
 
         # Test webapi apps
         print("Testing webapi apps...")
-        for proj in ["webapi", "webapiaot"]:
-            self._test_webapi(proj, framework)
-            print(f"✓ {proj} test passed")
-
-    def _test_webapi(self, project: str, framework: str):
+        with ThreadPoolExecutor(max_workers=len(WEBAPI_PORTS)) as executor:
+            futures = {
+                executor.submit(self._test_webapi, proj, framework, port): proj
+                for proj, port in WEBAPI_PORTS.items()
+            }
+            for future in as_completed(futures):
+                error = future.exception()
+                if error is not None:
+                    raise error
+                print(f"✓ {futures[future]} test passed")
+
+    def _test_webapi(self, project: str, framework: str, port: int = 5000):
         """Test a web API project"""
-        with tempfile.NamedTemporaryFile(mode="w+", delete=False) as temp_file:
-            temp_output = temp_file.name
+        webapi_path = f"./{project}/bin/Debug/{framework}/{project}"
+        webapi_process = subprocess.Popen(
+            [webapi_path, "--urls", f"http://localhost:{port}"],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=1,
+            text=True,
+            # Our own fds are non-inheritable, so skip the close-fds walk
+            close_fds=False,
+            start_new_session=True,
+        )
+
+        # Keep draining stdout so the child never blocks on a full pipe
+        started = threading.Event()
+
+        def watch_output():
+            for line in webapi_process.stdout:
+                if "Now listening on:" in line:
+                    started.set()
+
+        reader = threading.Thread(target=watch_output, daemon=True)
+        reader.start()
 
         try:
-            webapi_path = f"./{project}/bin/Debug/{framework}/{project}"
-            with open(temp_output, "w") as f:
-                webapi_process = subprocess.Popen(
-                    [webapi_path], stdout=f, stderr=subprocess.STDOUT
-                )
-
             # Wait for the service to start
-            timeout = 10
-            start_time = time.time()
-            while time.time() - start_time < timeout:
-                try:
-                    with open(temp_output, "r") as f:
-                        content = f.read()
-                        if "Now listening on:" in content:
-                            break
-                except:
-                    pass
-                time.sleep(0.1)
-            else:
+            if not started.wait(timeout=10):
                 print(f"Timeout waiting for {project} to start")
                 webapi_process.terminate()
                 sys.exit(1)
 
             # Test the API
             try:
-                response = requests.get("http://localhost:5000/TEST", timeout=5)
-                result = response.text.strip()
+                response = _session(port).get(
+                    f"http://localhost:{port}/TEST", timeout=5
+                )
+                result = response.content.strip()
             except requests.RequestException as e:
                 print(f"Failed to connect to {project}: {e}")
                 webapi_process.terminate()
@@ -200,12 +368,19 @@ class DotNetTester:
             webapi_process.terminate()
             webapi_process.wait()
 
-            if result != "SUCCESS":
-                print(f"{project} test failed: expected 'SUCCESS', got '{result}'")
+            if result != b"SUCCESS":
+                print(
+                    f"{project} test failed: expected 'SUCCESS', got '{result.decode(errors='replace')}'"
+                )
                 sys.exit(1)
 
         finally:
-            os.unlink(temp_output)
+            # A new session does not see our Ctrl-C, so never leave it running
+            if webapi_process.poll() is None:
+                webapi_process.kill()
+                webapi_process.wait()
+            reader.join(timeout=1)
+            webapi_process.stdout.close()
 
     def run_other_tests(self, versions: List[str]):
         """Run additional test scripts"""
@@ -228,83 +403,80 @@ class DotNetTester:
         """Test single file executables after removing dotnet"""
         print("\n=== Testing single file executables ===")
 
-        pattern = "./console/bin/Release/*/solus.4-x64/publish/console"
-        executables = glob.glob(pattern)
+        release_dir = "./console/bin/Release"
+        executables = []
+        if os.path.isdir(release_dir):
+            with os.scandir(release_dir) as entries:
+                for e in entries:
+                    exe_path = os.path.join(e.path, "solus.4-x64", "publish", "console")
+                    if e.is_dir() and os.path.isfile(exe_path):
+                        executables.append(exe_path)
 
         if not executables:
             print("No single file executables found to test")
             return
 
         for exe_path in executables:
-            framework_match = re.search(r"net(\d+)\.\d+", exe_path)
+            framework_match = _FW_RE.search(exe_path)
             if framework_match:
                 major_version = framework_match.group(1)
                 print(f"Testing self-contained executable for .NET {major_version}...")
 
-                with tempfile.NamedTemporaryFile(mode="w+", delete=False) as temp_file:
-                    temp_output = temp_file.name
-
-                try:
-                    with open(temp_output, "w") as f:
-                        result = subprocess.run(
-                            [exe_path], stdout=f, stderr=subprocess.STDOUT
-                        )
-
-                    if result.returncode != 0:
-                        print(
-                            f"Self-contained executable for .NET {major_version} failed with exit code {result.returncode}"
-                        )
-                        sys.exit(1)
-
-                    with open(temp_output, "r") as f:
-                        output = f.read().strip()
+                result = subprocess.run(
+                    [exe_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+                )
 
-                    if output != "SUCCESS":
-                        print(
-                            f".NET {major_version} failed to create self-contained executable"
-                        )
-                        sys.exit(1)
+                if result.returncode != 0:
+                    print(
+                        f"Self-contained executable for .NET {major_version} failed with exit code {result.returncode}"
+                    )
+                    sys.exit(1)
 
+                if result.stdout.strip() != b"SUCCESS":
                     print(
-                        f"✓ .NET {major_version} self-contained executable test passed"
+                        f".NET {major_version} failed to create self-contained executable"
                     )
+                    sys.exit(1)
 
-                finally:
-                    os.unlink(temp_output)
+                print(f"✓ .NET {major_version} self-contained executable test passed")
+
+    def _plan_combinations(self, versions: List[str]) -> List[Tuple[str, ...]]:
+        """Get the unique install sets to exercise for the given versions"""
+        versions = list(dict.fromkeys(versions))
+        candidates = [(version,) for version in versions]
+        if len(versions) > 1:
+            candidates.append(tuple(versions))
+        if len(versions) > 2:
+            candidates.extend(combinations(versions, 2))
+
+        plan = []
+        seen = set()
+        for install_set in candidates:
+            key = frozenset(install_set)
+            if key not in seen:
+                seen.add(key)
+                plan.append(install_set)
+        return plan
 
     def test_version_combinations(self, versions: List[str]):
         """Test various combinations of .NET versions"""
-        for version in versions:
-            print(f"\n{'='*60}")
-            print(f"Testing .NET {version} standalone")
-            print("=" * 60)
-            self.uninstall_all_dotnet()
-            self.install_dotnet([version])
-            self.run_tests(version)
+        plan = self._plan_combinations(versions)
+        total = max(len(install_set) for install_set in plan)
 
-        if len(versions) > 1:
+        for install_set in plan:
             print(f"\n{'='*60}")
-            print(f"Testing all versions together: .NET {', '.join(versions)}")
+            if len(install_set) == 1:
+                print(f"Testing .NET {install_set[0]} standalone")
+            elif len(install_set) == total:
+                print(f"Testing all versions together: .NET {', '.join(install_set)}")
+            else:
+                print(f"Testing pair: .NET {install_set[0]} and {install_set[1]}")
             print("=" * 60)
-            self.uninstall_all_dotnet()
-            self.install_dotnet(versions)
+            self.switch_to(list(install_set))
 
-            for version in versions:
+            for version in install_set:
                 self.run_tests(version)
 
-        if len(versions) > 2:
-            for i in range(len(versions)):
-                for j in range(i + 1, len(versions)):
-                    pair = [versions[i], versions[j]]
-                    print(f"\n{'='*60}")
-                    print(f"Testing pair: .NET {pair[0]} and {pair[1]}")
-                    print("=" * 60)
-                    self.uninstall_all_dotnet()
-                    self.install_dotnet(pair)
-
-                    for version in pair:
-                        self.run_tests(version)
-
 
 def main():
     if len(sys.argv) < 2:
@@ -316,17 +488,18 @@ def main():
     versions = sys.argv[1:]
     tester = DotNetTester()
 
+    # Already sorted once at enumeration time
     available = tester.get_available_versions()
-    print(f"Available .NET versions: {', '.join(sorted(available))}")
+    available_list = ", ".join(available)
+    print(f"Available .NET versions: {available_list}")
 
     print("\nPackage analysis:")
-    for version in sorted(tester.versions.keys()):
+    for version in sorted(tester.versions):
         packages = tester.versions[version]
         if version == "shared":
             print(f"  Shared: {len(packages)} package(s)")
         else:
-            sdk_count = sum(1 for p in packages if "sdk" in os.path.basename(p).lower())
-            runtime_count = len(packages) - sdk_count
+            runtime_count, sdk_count = tester.get_package_counts(version)
             print(
                 f"  .NET {version}: {runtime_count} runtime, {sdk_count} SDK package(s)"
             )
@@ -334,11 +507,11 @@ def main():
     invalid_versions = [v for v in versions if v not in available]
     if invalid_versions:
         print(f"\nError: Version(s) {', '.join(invalid_versions)} not found")
-        print(f"Available versions: {', '.join(sorted(available))}")
+        print(f"Available versions: {available_list}")
         sys.exit(1)
 
     print("\nCleaning git repository...")
-    tester.run_command("git clean -xfd")
+    tester.run_command(["git", "clean", "-xfd"], quiet=True)
 
     tester.test_version_combinations(versions)
 